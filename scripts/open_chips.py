@@ -5,7 +5,7 @@ import xarray as xr
 
 
 def open_chips(input_path: Path) -> xr.Dataset:
-    ds = xr.open_zarr(input_path)
+    ds = xr.open_zarr(input_path, consolidated=True)
     return ds
 
 
@@ -1,18 +1,22 @@
 import argparse
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
 import numpy as np
+import shapely
 import xarray as xr
-from tqdm import tqdm
 
 import satchip
 from satchip import utils
-from satchip.chip_hls import get_hls_data
+from satchip.chip_hls import get_hls_data, login
 from satchip.chip_sentinel1rtc import get_s1rtc_data
-from satchip.chip_sentinel2 import get_s2l2a_data
-from satchip.terra_mind_grid import TerraMindGrid
+from satchip.chip_sentinel2 import get_items_tree, get_s2l2a_data, search_s2l2a_items
+from satchip.chip_xr_base import BAND_WORKERS
+from satchip.terra_mind_grid import TerraMindChip, TerraMindGrid
 
 
 GET_DATA_FNS = {'S2L2A': get_s2l2a_data, 'S1RTC': get_s1rtc_data, 'HLS': get_hls_data}
@@ -34,6 +38,19 @@ def fill_missing_times(data_chip: xr.DataArray, times: np.ndarray) -> xr.DataArr
     return xr.concat([data_chip, missing_data], dim='time').sortby('time')
 
 
+def get_data_chips(
+    get_data_fn: Callable, terra_mind_chips: list[TerraMindChip], scratch_dir: Path, opts: dict, max_workers: int
+) -> list[xr.DataArray]:
+    """Fetch the data chips concurrently, returning them in the same order as terra_mind_chips.
+
+    Each chip is mostly network I/O and GDAL work that releases the GIL, so threads let the
+    downloads for one chip overlap with the warping of another.
+    """
+    get_chip = partial(get_data_fn, scratch_dir=scratch_dir, opts=opts)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(utils.progress_bar(executor.map(get_chip, terra_mind_chips), total=len(terra_mind_chips)))
+
+
 def chip_data(
     label_path: Path,
     platform: str,
@@ -43,6 +60,7 @@ def chip_data(
     max_cloud_pct: int,
     output_dir: Path,
     scratch_dir: Path | None = None,
+    max_workers: int = 16,
 ) -> xr.Dataset:
     get_data_fn = GET_DATA_FNS[platform]
     labels = utils.load_chip(label_path)
@@ -52,18 +70,23 @@ def chip_data(
     terra_mind_chips = [c for c in grid.terra_mind_chips if c.name in list(labels.sample.data)]
 
     opts = {'strategy': strategy, 'date_start': date_start, 'date_end': date_end}
+    # Chips are fetched concurrently, so the cores are split between them for the local band warps
+    opts['band_workers'] = max(1, BAND_WORKERS // max_workers)
     if platform in ['S2L2A', 'HLS']:
         opts['max_cloud_pct'] = max_cloud_pct
+    if platform == 'HLS':
+        # Logging in before the chip threads start keeps them from all waiting on the first chip's login
+        login()
+    if platform == 'S2L2A':
+        # One search over all the chips replaces a search per chip
+        items = search_s2l2a_items(shapely.box(*bounds), date_start, date_end)
+        opts['items'], opts['items_tree'] = items, get_items_tree(items)
 
-    data_chips = []
     if scratch_dir is not None:
-        for chip in tqdm(terra_mind_chips):
-            data_chips.append(get_data_fn(chip, scratch_dir, opts=opts))
+        data_chips = get_data_chips(get_data_fn, terra_mind_chips, scratch_dir, opts, max_workers)
     else:
         with TemporaryDirectory() as tmp_dir:
-            scratch_dir = Path(tmp_dir)
-            for chip in tqdm(terra_mind_chips):
-                data_chips.append(get_data_fn(chip, scratch_dir, opts=opts))
+            data_chips = get_data_chips(get_data_fn, terra_mind_chips, Path(tmp_dir), opts, max_workers)
 
     times = np.unique(np.concatenate([dc.time.data for dc in data_chips]))
     for i, data_chip in enumerate(data_chips):
@@ -73,7 +96,7 @@ def chip_data(
     dataset = xr.Dataset(attrs=attrs)
     dataset['data'] = xr.combine_by_coords(data_chips, join='override')
     output_path = output_dir / (label_path.with_suffix('').with_suffix('').name + f'_{platform}.zarr.zip')
-    utils.save_chip(dataset, output_path)
+    utils.save_chip(dataset, output_path, encoding={'data': utils.get_chip_encoding(dataset['data'])})
     return labels
 
 
@@ -85,7 +108,10 @@ def main() -> None:
     parser.add_argument('--maxcloudpct', default=100, type=int, help='Maximum percent cloud cover for a data chip')
     parser.add_argument('--outdir', default='.', type=Path, help='Output directory for the chips')
     parser.add_argument(
-        '--scratchdir', default=None, type=Path, help='Output directory for scratch files if you want to keep them'
+        '--scratchdir',
+        default=None,
+        type=Path,
+        help='Output directory for scratch (HLS and S1RTC) files if you want to keep them',
     )
     parser.add_argument(
         '--strategy',
@@ -1,14 +1,16 @@
+import threading
 from datetime import datetime, timedelta
+from functools import lru_cache
 from pathlib import Path
 
 import earthaccess
 import numpy as np
-import rioxarray
 import shapely
 import xarray as xr
 from earthaccess.results import DataGranule
 
-from satchip.chip_xr_base import create_template_da
+from satchip import utils
+from satchip.chip_xr_base import BAND_WORKERS, is_within_bad_pixel_limit, stack_to_chip_dataarray, warp_bands_to_chip
 from satchip.terra_mind_grid import TerraMindChip
 
 
@@ -31,6 +33,21 @@ HLS_S_BANDS = {
     'B12': 'SWIR22',
 }
 BAND_SETS = {'L30': HLS_L_BANDS, 'S30': HLS_S_BANDS}
+# Cirrus (bit 0), cloud (bit 1) and cloud shadow (bit 3) flags of the Fmask. See table 9 and appendix A of:
+# https://lpdaac.usgs.gov/documents/1698/HLS_User_Guide_V2.pdf
+FMASK_BAD_BITS = np.uint8((1 << 0) | (1 << 1) | (1 << 3))
+_LOGIN_LOCK = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _login() -> earthaccess.Auth:
+    return earthaccess.login()
+
+
+def login() -> None:
+    """Log in to Earthdata once per process, so concurrent chips don't each log in."""
+    with _LOGIN_LOCK:
+        _login()
 
 
 def get_pct_intersect(umm: dict, roi: shapely.geometry.Polygon) -> float:
@@ -50,6 +67,10 @@ def get_product_id(umm: dict) -> str:
     return [x['Identifier'] for x in umm['DataGranule']['Identifiers'] if x['IdentifierType'] == 'ProducerGranuleId'][0]
 
 
+def get_bad_pixels(fmask: np.ndarray) -> np.ndarray:
+    return (fmask & FMASK_BAD_BITS) != 0
+
+
 def get_scenes(
     items: list[DataGranule], roi: shapely.geometry.Polygon, max_cloud_pct: int, strategy: str, scratch_dir: Path
 ) -> list[DataGranule]:
@@ -73,18 +94,13 @@ def get_scenes(
     valid_scenes = []
     for item in best_first:
         product_id = get_product_id(item['umm'])
-        n_products = len(list(scratch_dir.glob(f'{product_id}*')))
-        if n_products < 15:
-            earthaccess.download([item], scratch_dir, pqdm_kwargs={'disable': True})
+        with utils.get_path_lock(scratch_dir / product_id):
+            n_products = len(list(scratch_dir.glob(f'{product_id}*')))
+            if n_products < 15:
+                earthaccess.download([item], scratch_dir, pqdm_kwargs={'disable': True})
         fmask_path = scratch_dir / f'{product_id}.v2.0.FMask.tif'
         assert fmask_path.exists(), f'File not found: {fmask_path}'
-        qual_da = rioxarray.open_rasterio(fmask_path).rio.clip_box(*roi.bounds, crs='EPSG:4326')  # type: ignore
-        bit_masks = np.unpackbits(qual_da.data[0][..., np.newaxis], axis=-1)
-        # Looks for a 1 in the 4th, 6th and 7th bit of the Fmask (reverse order). See table 9 and appendix A of:
-        # https://lpdaac.usgs.gov/documents/1698/HLS_User_Guide_V2.pdf
-        bad_pixels = (bit_masks[..., 4] == 1) | (bit_masks[..., 6] == 1) | (bit_masks[..., 7] == 1)
-        pct_bad = int(np.round(100 * np.sum(bad_pixels) / bad_pixels.size))
-        if pct_bad <= max_cloud_pct:
+        if is_within_bad_pixel_limit(fmask_path, roi.bounds, get_bad_pixels, max_cloud_pct):
             if strategy == 'BEST':
                 return [item]
             else:
@@ -99,33 +115,25 @@ def get_hls_data(chip: TerraMindChip, scratch_dir: Path, opts: dict) -> xr.DataA
     """
     date_start = opts['date_start']
     date_end = opts['date_end'] + timedelta(days=1)  # inclusive end
-    earthaccess.login()
+    login()
     results = earthaccess.search_data(
         short_name=['HLSL30', 'HLSS30'], bounding_box=chip.bounds, temporal=(date_start, date_end)
     )
     assert len(results) > 0, f'No HLS scenes found for chip {chip.name} between {date_start} and {date_end}.'
     roi = shapely.box(*chip.bounds)
-    roi_buffered = roi.buffer(0.01)
     max_cloud_pct = opts.get('max_cloud_pct', 100)
     strategy = opts.get('strategy', 'BEST').upper()
-    scenes = get_scenes(results, roi, max_cloud_pct, strategy, scratch_dir)
-    das = []
-    template = create_template_da(chip)
+    scenes = sorted(get_scenes(results, roi, max_cloud_pct, strategy, scratch_dir), key=lambda x: get_date(x['umm']))
+    times = [get_date(scene['umm']).replace(tzinfo=None) for scene in scenes]
+    image_paths = []
     for scene in scenes:
         product_id = get_product_id(scene['umm'])
         bands = BAND_SETS[product_id.split('.')[1]]
-        for band in bands:
-            image_path = scratch_dir / f'{product_id}.v2.0.{band}.tif'
-            da = rioxarray.open_rasterio(image_path).rio.clip_box(*roi_buffered.bounds, crs='EPSG:4326')  # type: ignore
-            da_reproj = da.rio.reproject_match(template)
-            da_reproj['band'] = [bands[band]]
-            da_reproj = da_reproj.expand_dims({'time': [get_date(scene['umm']).replace(tzinfo=None)]})
-            da_reproj['x'] = np.arange(0, chip.ncol)
-            da_reproj['y'] = np.arange(0, chip.nrow)
-            da_reproj.attrs = {}
-            das.append(da_reproj)
-    dataarray = xr.combine_by_coords(das, join='override').drop_vars('spatial_ref')
-    assert isinstance(dataarray, xr.DataArray)
+        band_ids = sorted(bands, key=lambda band: bands[band])
+        image_paths += [scratch_dir / f'{product_id}.v2.0.{band}.tif' for band in band_ids]
+    # L30 and S30 scenes share the same band names, so every scene stacks in the same order
+    band_names = sorted(HLS_L_BANDS.values())
+    stack = warp_bands_to_chip(image_paths, chip, max_workers=opts.get('band_workers', BAND_WORKERS))
+    dataarray = stack_to_chip_dataarray(stack, times, band_names, chip)
     dataarray = dataarray.expand_dims({'sample': [chip.name], 'platform': ['HLS']})
-    dataarray.attrs = {}
     return dataarray
@@ -1,15 +1,28 @@
 import argparse
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import partial
 from pathlib import Path
 
 import numpy as np
 import rasterio as rio
 import xarray as xr
-from tqdm import tqdm
+from rasterio import Affine
+from rasterio.vrt import WarpedVRT
 
 import satchip
 from satchip import utils
-from satchip.terra_mind_grid import TerraMindGrid
+from satchip.chip_xr_base import WARP_MEM_LIMIT, get_chip_crs
+from satchip.terra_mind_grid import (
+    MJ_TM_RATIO,
+    TERRA_MIND_CHIP_SIZE,
+    TERRA_MIND_PIXEL_SIZE,
+    MajorTomChip,
+    TerraMindChip,
+    TerraMindGrid,
+)
 
 
 def get_overall_bounds(bounds: list) -> list:
@@ -21,49 +34,107 @@ def get_overall_bounds(bounds: list) -> list:
 
 
 def is_valuable(chip: np.ndarray) -> bool:
-    vals = list(np.unique(chip))
-    return not vals == [0]
+    return bool(np.any(chip))
+
+
+def get_label_dtype(label_np: np.ndarray) -> type[np.integer]:
+    """Return uint8 if all label values fit in it, otherwise int16."""
+    if label_np.size > 0 and label_np.min() >= 0 and label_np.max() <= np.iinfo(np.uint8).max:
+        return np.uint8
+    return np.int16
+
+
+def _reproject_major_tom_chip(mt_chip: MajorTomChip, label_path: Path) -> list[tuple[str, np.ndarray]]:
+    """Reproject the label image to the TerraMind chips of a single MajorTom chip.
+
+    The TerraMind chips of a MajorTom chip share one pixel grid, so the label is warped once onto a
+    mosaic covering all of them and the chips are sliced out of it. GDAL's approximate transformer
+    depends on the extent of the destination, so the warp uses a negligible tolerance, which makes GDAL
+    use the exact transformer and keeps each chip independent of the mosaic it is sliced from. The label is opened inside the worker
+    so that only the path, not the data, is sent between processes.
+    """
+    tm_chips = TerraMindGrid.get_terra_mind_chips_for_major_tom_chip(mt_chip)
+    minx = min(tm_chip.minx for tm_chip in tm_chips)
+    maxy = max(tm_chip.maxy for tm_chip in tm_chips)
+    size = MJ_TM_RATIO * TERRA_MIND_CHIP_SIZE
+    with (
+        rio.open(label_path) as src,
+        WarpedVRT(
+            src,
+            crs=get_chip_crs(mt_chip.epsg),
+            transform=Affine(TERRA_MIND_PIXEL_SIZE, 0.0, minx, 0.0, -TERRA_MIND_PIXEL_SIZE, maxy),
+            width=size,
+            height=size,
+            nodata=np.nan,
+            dtype='float32',
+            resampling=rio.enums.Resampling(1),
+            # rasterio fails to build the VRT with tolerance=0 and an explicit transform, width and height
+            tolerance=1e-9,
+            warp_mem_limit=WARP_MEM_LIMIT,
+        ) as vrt,
+    ):
+        # Each pool worker already has its own core, so the warp is left single threaded
+        mosaic = vrt.read(1)
+    # Zero the nodata and round in place so the only new allocation is the int16 cast
+    np.nan_to_num(mosaic, copy=False, nan=0.0)
+    mosaic_int = np.rint(mosaic, out=mosaic).astype(np.int16)
+    # MajorTom chips off the edge of the label are common, so check the whole mosaic once before each chip
+    if not is_valuable(mosaic_int):
+        return []
+    results = []
+    for tm_chip in tm_chips:
+        row = round((maxy - tm_chip.maxy) / TERRA_MIND_PIXEL_SIZE)
+        col = round((tm_chip.minx - minx) / TERRA_MIND_PIXEL_SIZE)
+        chip_array = mosaic_int[row : row + tm_chip.nrow, col : col + tm_chip.ncol]
+        if is_valuable(chip_array):
+            results.append((tm_chip.name, chip_array))
+    return results
 
 
 def chip_labels(label_path: Path, date: datetime, output_dir: Path) -> Path:
     label = xr.open_dataarray(label_path)
     bbox = utils.get_epsg4326_bbox(label.rio.bounds(), label.rio.crs.to_epsg())
     tm_grid = TerraMindGrid(latitude_range=(bbox[1], bbox[3]), longitude_range=(bbox[0], bbox[2]))
-    chips = {}
-    for tm_chip in tqdm(tm_grid.terra_mind_chips):
-        chip = label.rio.reproject(
-            dst_crs=f'EPSG:{tm_chip.epsg}',
-            resampling=rio.enums.Resampling(1),
-            transform=tm_chip.rio_transform,
-            shape=(tm_chip.nrow, tm_chip.ncol),
-        )
-        chip_array = chip.data[0]
-        chip_array[np.isnan(chip_array)] = 0
-        chip_array = np.round(chip_array).astype(np.int16)
-        if is_valuable(chip_array):
-            chips[tm_chip.name] = [chip_array, tm_chip]
+    tm_chips = {tm_chip.name: tm_chip for tm_chip in tm_grid.terra_mind_chips}
+    reproject_mt_chip = partial(_reproject_major_tom_chip, label_path=label_path)
+    chips: list[TerraMindChip] = []
+    chip_arrays: list[np.ndarray] = []
+    # GDAL is not fork-safe, so workers are spawned rather than forked
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=context) as executor:
+        results = executor.map(reproject_mt_chip, tm_grid.major_tom_chips)
+        for mt_results in utils.progress_bar(results, total=len(tm_grid.major_tom_chips)):
+            for name, chip_array in mt_results:
+                chip_arrays.append(chip_array)
+                chips.append(tm_chips[name])
 
     if len(chips) == 0:
         raise ValueError(f'No valid chips found for {label_path.name}')
 
+    # The number of valuable chips is only known after the warps, and a buffer sized for every chip of the grid
+    # would dwarf the kept chips, so they are stacked once at the end
+    label_np = np.stack(chip_arrays)[np.newaxis, np.newaxis]
+    del chip_arrays
+    # Most label sets are class ids that fit in a byte, which halves the size of the chips
+    label_np = label_np.astype(get_label_dtype(label_np), copy=False)
+
     coords = {
         'time': np.array([date]),
         'band': np.array(['labels']),
-        'sample': np.array([str(x) for x in chips.keys()]),
-        'y': np.arange(0, chip_array.shape[0]),
-        'x': np.arange(0, chip_array.shape[1]),
+        'sample': np.array([chip.name for chip in chips]),
+        'y': np.arange(0, TERRA_MIND_CHIP_SIZE),
+        'x': np.arange(0, TERRA_MIND_CHIP_SIZE),
     }
     print(f'Found {len(chips)} valid chips for {label_path.name}')
-    label_np = np.expand_dims(np.stack([val[0] for val in chips.values()], axis=0), axis=[0, 1])
-    lats, lons = zip(*[val[1].center for val in chips.values()])
+    lats, lons = zip(*[chip.center for chip in chips])
 
     dataset = xr.Dataset(attrs={'date_created': date.isoformat(), 'satchip_version': satchip.__version__})
-    dataset.attrs['bounds'] = get_overall_bounds([val[1].bounds for val in chips.values()])
+    dataset.attrs['bounds'] = get_overall_bounds([chip.bounds for chip in chips])
     dataset['bands'] = xr.DataArray(label_np, coords=coords, dims=list(coords.keys()))
     dataset['lats'] = xr.DataArray(np.array(lats), coords={'sample': coords['sample']}, dims=['sample'])
     dataset['lons'] = xr.DataArray(np.array(lons), coords={'sample': coords['sample']}, dims=['sample'])
     output_path = output_dir / label_path.with_suffix('.zarr.zip').name
-    utils.save_chip(dataset, output_path)
+    utils.save_chip(dataset, output_path, encoding={'bands': utils.get_chip_encoding(dataset['bands'])})
     return output_path
 
 
@@ -1,17 +1,19 @@
-from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache
 from pathlib import Path
 from urllib.parse import urlparse
 
 import numpy as np
-import rioxarray
-import s3fs
+import rasterio
 import shapely
 import xarray as xr
 from pystac.item import Item
 from pystac_client import Client
+from pystac_client.stac_api_io import StacApiIO
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from satchip.chip_xr_base import create_template_da
+from satchip.chip_xr_base import is_within_bad_pixel_limit, stack_to_chip_dataarray, warp_bands_to_chip
 from satchip.terra_mind_grid import TerraMindChip
 
 
@@ -30,11 +32,50 @@ S2_BANDS = {
     'B12': 'SWIR22',
 }
 
-S3_FS = s3fs.S3FileSystem(anon=True)
+# Lookup table flagging nodata (0), defective pixels (1), cloud shadows (3), clouds (8/9) and cirrus (10)
+# See https://custom-scripts.sentinel-hub.com/custom-scripts/sentinel-2/scene-classification/
+# for details on SCL values
+SCL_IS_BAD = np.zeros(256, dtype=bool)
+SCL_IS_BAD[[0, 1, 3, 8, 9, 10]] = True
+
+# Read band COGs in place with range requests instead of downloading whole scenes
+S3_GDAL_ENV = {
+    'AWS_NO_SIGN_REQUEST': 'YES',
+    'AWS_REGION': 'us-west-2',
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+    'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.tif',
+    'CPL_VSIL_CURL_USE_HEAD': 'NO',
+    'GDAL_HTTP_MULTIPLEX': 'YES',
+    'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
+    'VSI_CACHE': 'TRUE',
+    'VSI_CACHE_SIZE': str(64 * 1024 * 1024),
+    # The curl region cache is shared by every open file handle, so neighboring chips reuse the tiles read for a scene
+    'CPL_VSIL_CURL_CACHE_SIZE': str(256 * 1024 * 1024),
+}
+
+EARTH_SEARCH_URL = 'https://earth-search.aws.element84.com/v1'
+STAC_POOL_SIZE = 32
+STAC_PAGE_SIZE = 100
+
+
+@lru_cache(maxsize=1)
+def get_stac_client() -> Client:
+    """Returns the Earth Search STAC client, opened once and shared by every chip.
+
+    The session's connection pool is sized so concurrent chip searches reuse connections instead of opening new ones,
+    and throttled or failed requests are retried with backoff. Searches are POSTs but are safe to retry.
+    """
+    stac_io = StacApiIO()
+    retries = Retry(
+        total=5, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=('GET', 'POST')
+    )
+    adapter = HTTPAdapter(pool_connections=STAC_POOL_SIZE, pool_maxsize=STAC_POOL_SIZE, max_retries=retries)
+    stac_io.session.mount('https://', adapter)
+    return Client.open(EARTH_SEARCH_URL, stac_io=stac_io)
 
 
 def url_to_s3path(url: str) -> str:
-    """Converts an S3 URL to an S3 path usable by s3fs."""
+    """Converts an S3 URL to a bucket/key path."""
     parsed = urlparse(url)
     netloc_parts = parsed.netloc.split('.')
     if 's3' in netloc_parts:
@@ -45,48 +86,46 @@ def url_to_s3path(url: str) -> str:
     return f'{bucket}/{key}'
 
 
-def url_to_localpath(url: str, scratch_dir: Path) -> Path:
-    """Converts an S3 URL to a local file path in the given scratch directory."""
-    parsed = urlparse(url)
-    name = '_'.join(parsed.path.lstrip('/').split('/')[-2:])
-    local_file_path = scratch_dir / name
-    return local_file_path
+def url_to_vsis3path(url: str) -> str:
+    """Converts an S3 URL to a GDAL /vsis3/ path."""
+    return f'/vsis3/{url_to_s3path(url)}'
+
 
+def get_pct_intersects(items: list[Item], roi: shapely.geometry.Polygon) -> np.ndarray:
+    """Returns the fraction of the roi polygon that intersects with each item's geometry."""
+    footprints = [None if item.geometry is None else shapely.geometry.shape(item.geometry) for item in items]
+    intersection_areas = shapely.area(shapely.intersection(np.array(footprints, dtype=object), roi))
+    return np.nan_to_num(intersection_areas / roi.area, nan=0.0)
 
-def fetch_s3_file(url: str, scratch_dir: Path) -> Path:
-    """Fetches an S3 file to the given scratch directory if it doesn't already exist."""
-    local_path = url_to_localpath(url, scratch_dir)
-    if not local_path.exists():
-        s3_path = url_to_s3path(url)
-        S3_FS.get(s3_path, str(local_path))
-    return local_path
 
+def get_bbox_2d(bbox: list[float] | None) -> tuple[float, float, float, float]:
+    """Returns the 2D part of a STAC bbox, which may also hold elevations (minx, miny, minz, maxx, maxy, maxz).
 
-def multithread_fetch_s3_file(urls: list[str], scratch_dir: Path, max_workers: int = 8) -> None:
-    """Fetches multiple S3 files to the given scratch directory using multithreading."""
-    s3_paths, download_paths = [], []
-    for url in urls:
-        local_path = url_to_localpath(url, scratch_dir)
-        if not local_path.exists():
-            download_paths.append(local_path)
-            s3_paths.append(url_to_s3path(url))
+    Missing bboxes and bboxes crossing the antimeridian are returned as the whole world.
+    """
+    if bbox is None or len(bbox) not in (4, 6):
+        return (-180, -90, 180, 90)
+    half = len(bbox) // 2
+    minx, miny, maxx, maxy = bbox[0], bbox[1], bbox[half], bbox[half + 1]
+    if minx > maxx:
+        return (-180, -90, 180, 90)
+    return (minx, miny, maxx, maxy)
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        executor.map(S3_FS.get, s3_paths, download_paths)
 
+def get_items_tree(items: list[Item]) -> shapely.STRtree:
+    """Returns an STRtree over the bboxes of the items, so the items intersecting a chip can be found without a scan.
 
-def get_pct_intersect(scene_geom: dict | None, roi: shapely.geometry.Polygon) -> float:
-    """Returns the percent of the roi polygon that intersects with the scene geometry."""
-    if scene_geom is None:
-        return 0.0
-    image_footprint = shapely.geometry.shape(scene_geom)
-    intersection = roi.intersection(image_footprint)
-    return intersection.area / roi.area
+    Missing bboxes and bboxes crossing the antimeridian cover the whole world and are left to the footprint check.
+    """
+    bboxes = np.array([get_bbox_2d(item.bbox) for item in items], dtype=float).reshape(-1, 4)
+    return shapely.STRtree(shapely.box(*bboxes.T))
 
 
-def get_scenes(
-    items: list[Item], roi: shapely.geometry.Polygon, strategy: str, max_cloud_pct: int, scratch_dir: Path
-) -> list[Item]:
+def get_bad_pixels(scl: np.ndarray) -> np.ndarray:
+    return SCL_IS_BAD[scl]
+
+
+def get_scenes(items: list[Item], roi: shapely.geometry.Polygon, strategy: str, max_cloud_pct: int) -> list[Item]:
     """Returns the best Sentinel-2 L2A scene from the given list of items.
     The best scene is defined as the earliest scene with the largest intersection with the roi and
     less than or equal to the max_cloud_pct of bad pixels (nodata, defective, cloud).
@@ -95,7 +134,6 @@ def get_scenes(
         items: List of Sentinel-2 L2A items.
         roi: Region of interest polygon.
         max_cloud_pct: Maximum percent of bad pixels allowed in the scene.
-        scratch_dir: Directory to store downloaded files.
 
     Returns:
         The best Sentinel-2 L2A item.
@@ -103,21 +141,16 @@ def get_scenes(
     strategy = strategy.upper()
     assert strategy in ['BEST', 'ALL'], 'Strategy must be either BEST or ALL'
     assert len(items) > 0, 'No Sentinel-2 L2A scenes found for chip.'
-    items = [item for item in items if get_pct_intersect(item.geometry, roi) > 0.95]
-    best_first = sorted(items, key=lambda x: (-get_pct_intersect(x.geometry, roi), x.datetime))
+    pct_intersects = get_pct_intersects(items, roi)
+    overlapping = [i for i in range(len(items)) if pct_intersects[i] > 0.95]
+    best_first = [items[i] for i in sorted(overlapping, key=lambda i: (-pct_intersects[i], items[i].datetime))]
     valid_scenes = []
     for item in best_first:
-        scl_href = item.assets['scl'].href
-        local_path = fetch_s3_file(scl_href, scratch_dir)
-        assert local_path.exists(), f'File not found: {local_path}'
-        scl_da = rioxarray.open_rasterio(local_path).rio.clip_box(*roi.bounds, crs='EPSG:4326')  # type: ignore
-        scl_array = scl_da.data[0]
-        # Looks for nodata (0), defective pixels (1), cloud shadows (3), clouds (8/9), cirrus (10)
-        # See https://custom-scripts.sentinel-hub.com/custom-scripts/sentinel-2/scene-classification/
-        # for details on SCL values
-        bad_pixels = np.isin(scl_array, [0, 1, 3, 8, 9, 10])
-        pct_bad = int(np.round(np.sum(bad_pixels) / bad_pixels.size * 100))
-        if pct_bad <= max_cloud_pct:
+        # Only the chip window of the SCL is needed, so it is read in place instead of downloaded
+        scl_path = url_to_vsis3path(item.assets['scl'].href)
+        with rasterio.Env(**S3_GDAL_ENV):
+            within_limit = is_within_bad_pixel_limit(scl_path, roi.bounds, get_bad_pixels, max_cloud_pct)
+        if within_limit:
             if strategy == 'BEST':
                 return [item]
             else:
@@ -127,58 +160,73 @@ def get_scenes(
     return valid_scenes
 
 
+def search_s2l2a_items(
+    roi: shapely.geometry.Polygon, date_start: datetime, date_end: datetime, max_items: int | None = None
+) -> list[Item]:
+    """Search Earth Search for the Sentinel-2 L2A items intersecting the roi within an inclusive date range.
+
+    Args:
+        roi: Region of interest polygon.
+        date_start: Start date for the search.
+        date_end: Inclusive end date for the search.
+        max_items: Maximum number of items to return, or None for all of them.
+
+    Returns:
+        List of Sentinel-2 L2A items.
+    """
+    date_end = date_end + timedelta(days=1)  # inclusive end
+    date_range = f'{datetime.strftime(date_start, "%Y-%m-%d")}/{datetime.strftime(date_end, "%Y-%m-%d")}'
+    search = get_stac_client().search(
+        collections=['sentinel-2-l2a'],
+        intersects=roi,
+        datetime=date_range,
+        max_items=max_items,
+        # Pages are linked by a next token so they can only be fetched one after another; fewer, larger pages
+        # cut the number of round trips
+        limit=STAC_PAGE_SIZE,
+    )
+    return list(search.items())
+
+
 def get_s2l2a_data(chip: TerraMindChip, scratch_dir: Path, opts: dict) -> xr.DataArray:
     """Get XArray DataArray of Sentinel-2 L2A image for the given bounds and best collection parameters.
 
     Args:
         chip: TerraMindChip object defining the area of interest.
-        scratch_dir: Directory to store downloaded files.
+        scratch_dir: Unused, Sentinel-2 L2A data is read directly from S3.
         opts: Options dictionary with the following keys
             - date_start: Start date for the search.
             - date_end: End date for the search.
             - strategy (optional): Strategy to use when multiple scenes are found.
             - max_cloud_pct (optional): Maximum percent of bad pixels allowed in the scene.
+            - items (optional): Items already searched for over an area containing the chip.
+              If not given, the chip is searched for on its own.
+            - items_tree (optional): STRtree from get_items_tree over the items. Built from the items if not given.
 
     Returns:
         XArray DataArray containing the Sentinel-2 L2A image data.
     """
     date_start = opts['date_start']
-    date_end = opts['date_end'] + timedelta(days=1)  # inclusive end
-    date_range = f'{datetime.strftime(date_start, "%Y-%m-%d")}/{datetime.strftime(date_end, "%Y-%m-%d")}'
+    date_end = opts['date_end']
     roi = shapely.box(*chip.bounds)
-    roi_buffered = roi.buffer(0.01)
-    client = Client.open('https://earth-search.aws.element84.com/v1')
-    search = client.search(
-        collections=['sentinel-2-l2a'],
-        intersects=roi,
-        datetime=date_range,
-        max_items=1000,
-    )
-    assert len(search.item_collection()) > 0, (
-        f'No Sentinel-2 L2A scenes found for chip {chip.name} between {date_start} and {date_end}.'
-    )
-    items = list(search.item_collection())
+    # Bboxes narrow the shared items down before any geometry is parsed or intersected
+    if 'items' in opts:
+        items_tree = opts['items_tree'] if 'items_tree' in opts else get_items_tree(opts['items'])
+        # Query results are sorted so the items keep their search order
+        items = [opts['items'][i] for i in np.sort(items_tree.query(roi))]
+    else:
+        items = search_s2l2a_items(roi, date_start, date_end, max_items=1000)
+    assert len(items) > 0, f'No Sentinel-2 L2A scenes found for chip {chip.name} between {date_start} and {date_end}.'
     max_cloud_pct = opts.get('max_cloud_pct', 100)
     strategy = opts.get('strategy', 'BEST')
-    items = get_scenes(items, roi, strategy, max_cloud_pct, scratch_dir)
-    urls = [item.assets[S2_BANDS[band].lower()].href for item in items for band in S2_BANDS]
-    multithread_fetch_s3_file(urls, scratch_dir)
-    template = create_template_da(chip)
-    das = []
-    for item in items:
-        for band in S2_BANDS:
-            local_path = url_to_localpath(item.assets[S2_BANDS[band].lower()].href, scratch_dir)
-            assert local_path.exists(), f'File not found: {local_path}'
-            da = rioxarray.open_rasterio(local_path).rio.clip_box(*roi_buffered.bounds, crs='EPSG:4326')  # type: ignore
-            da_reproj = da.rio.reproject_match(template)
-            da_reproj['band'] = [S2_BANDS[band]]
-            da_reproj = da_reproj.expand_dims({'time': [item.datetime.replace(tzinfo=None)]})  # type: ignore
-            da_reproj['x'] = np.arange(0, chip.ncol)
-            da_reproj['y'] = np.arange(0, chip.nrow)
-            da_reproj.attrs = {}
-            das.append(da_reproj)
-    dataarray = xr.combine_by_coords(das, join='override').drop_vars('spatial_ref')
-    assert isinstance(dataarray, xr.DataArray)
+    items = sorted(get_scenes(items, roi, strategy, max_cloud_pct), key=lambda item: item.datetime)
+    times = [item.datetime.replace(tzinfo=None) for item in items]
+    band_ids = sorted(S2_BANDS, key=lambda band: S2_BANDS[band])
+    image_paths = [url_to_vsis3path(item.assets[S2_BANDS[band].lower()].href) for item in items for band in band_ids]
+    # Every band of every scene is warped in one call so the reads of one scene don't wait on the previous one.
+    # They wait on S3 range requests rather than the CPU, so a full scene's worth of bands is fetched at once,
+    # deliberately oversubscribing the cores instead of using band_workers.
+    stack = warp_bands_to_chip(image_paths, chip, gdal_env=S3_GDAL_ENV, max_workers=len(band_ids))
+    dataarray = stack_to_chip_dataarray(stack, times, [S2_BANDS[band] for band in band_ids], chip)
     dataarray = dataarray.expand_dims({'sample': [chip.name], 'platform': ['S2L2A']})
-    dataarray.attrs = {}
     return dataarray
@@ -1,14 +1,142 @@
+import os
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+
 import numpy as np
+import rasterio
+import rioxarray
 import xarray as xr
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
 
 from satchip.terra_mind_grid import TerraMindChip
 
 
-def create_template_da(chip: TerraMindChip) -> xr.DataArray:
-    """Create a template DataArray with the same dimensions and transform as a label chip."""
-    x = np.arange(chip.nrow) * chip.gdal_transform[1] + chip.gdal_transform[0] + chip.gdal_transform[1] / 2
-    y = np.arange(chip.ncol) * chip.gdal_transform[5] + chip.gdal_transform[3] + chip.gdal_transform[5] / 2
-    template = xr.DataArray(np.zeros((chip.ncol, chip.nrow)), dims=('y', 'x'), coords={'y': y, 'x': x})
-    template.rio.write_crs(f'EPSG:{chip.epsg}', inplace=True)
-    template.rio.write_transform(chip.rio_transform, inplace=True)
-    return template
+BAND_WORKERS = max((os.cpu_count() or 1) - 1, 1)  # default number of bands warped at once
+WARP_MEM_LIMIT = 512  # MB
+
+
+@lru_cache(maxsize=64)
+def get_chip_crs(epsg: int) -> CRS:
+    """Return the rasterio CRS for a chip EPSG code, cached since each grid only spans a few UTM zones."""
+    return CRS.from_epsg(epsg)
+
+
+def warp_bands_to_chip(
+    image_paths: list,
+    chip: TerraMindChip,
+    resampling: Resampling = Resampling.nearest,
+    gdal_env: dict | None = None,
+    max_workers: int = BAND_WORKERS,
+) -> np.ndarray:
+    """Warp a set of single-band images onto the grid of a chip.
+
+    Each image is read through a WarpedVRT defined by the chip's CRS, transform and shape,
+    so GDAL clips and warps in one pass and only reads the source windows the chip needs.
+    The bands are independent, so they are read concurrently (GDAL releases the GIL) into
+    one preallocated (band, y, x) array. Remote images (e.g. /vsis3/ paths) are read with
+    range requests, so only the parts of each file covering the chip are transferred.
+
+    Args:
+        image_paths: Paths to the single-band images, in band order.
+        chip: TerraMindChip defining the output grid.
+        resampling: Resampling method to use for the warp.
+        gdal_env: GDAL configuration options to read the images with.
+        max_workers: Maximum number of bands to read at once. When several chips are warped at once, callers
+            should split BAND_WORKERS between them. Remote reads are latency-bound, so it can be raised
+            above the number of cores for them.
+
+    Returns:
+        Array of shape (len(image_paths), chip.nrow, chip.ncol).
+    """
+    assert len(image_paths) > 0, 'No images provided.'
+    crs = get_chip_crs(chip.epsg)
+    gdal_env = gdal_env or {}
+    with rasterio.Env(**gdal_env), rasterio.open(image_paths[0]) as src:
+        stack = np.empty((len(image_paths), chip.nrow, chip.ncol), dtype=src.dtypes[0])
+
+    def warp_band(i: int) -> None:
+        # rasterio environments are thread-local, so each worker enters its own
+        with (
+            rasterio.Env(**gdal_env),
+            rasterio.open(image_paths[i]) as src,
+            WarpedVRT(
+                src,
+                crs=crs,
+                transform=chip.rio_transform,
+                width=chip.ncol,
+                height=chip.nrow,
+                resampling=resampling,
+                warp_mem_limit=WARP_MEM_LIMIT,
+            ) as vrt,
+        ):
+            vrt.read(1, out=stack[i])
+
+    # Parallelism is across bands rather than inside GDAL's warper, so max_workers bounds the cores used
+    with ThreadPoolExecutor(max_workers=min(len(image_paths), max_workers)) as executor:
+        list(executor.map(warp_band, range(len(image_paths))))
+    return stack
+
+
+def stack_to_chip_dataarray(
+    stack: np.ndarray, times: list[datetime], band_names: list[str], chip: TerraMindChip
+) -> xr.DataArray:
+    """Wrap a (scene * band, y, x) stack from warp_bands_to_chip as a (time, band, y, x) DataArray.
+
+    The stack is reshaped rather than reordered, so the scenes must have been warped in time order
+    and the bands of every scene in the same order. Callers pass band_names sorted by name to match
+    the band order of previous releases.
+
+    Args:
+        stack: Array of shape (len(times) * len(band_names), chip.nrow, chip.ncol).
+        times: Acquisition time of each scene, in ascending order.
+        band_names: Name of each band, in the order the bands of each scene were warped.
+        chip: TerraMindChip the stack was warped onto.
+
+    Returns:
+        DataArray of the stack with time, band, y and x coordinates.
+    """
+    if len(set(times)) < len(times):
+        raise ValueError(f'Multiple scenes selected for chip {chip.name} share an acquisition time.')
+    return xr.DataArray(
+        stack.reshape(len(times), len(band_names), chip.nrow, chip.ncol),
+        dims=('time', 'band', 'y', 'x'),
+        coords={
+            'time': times,
+            'band': band_names,
+            'y': np.arange(0, chip.nrow),
+            'x': np.arange(0, chip.ncol),
+        },
+    )
+
+
+def read_clipped(image_path: str | Path, bounds: tuple) -> np.ndarray:
+    """Read the first band of an image clipped to EPSG:4326 bounds."""
+    da = rioxarray.open_rasterio(image_path).rio.clip_box(*bounds, crs='EPSG:4326')  # type: ignore
+    return da.data[0]
+
+
+def is_within_bad_pixel_limit(
+    quality_path: str | Path, bounds: tuple, get_bad_pixels: Callable[[np.ndarray], np.ndarray], max_pct_bad: int
+) -> bool:
+    """Check whether the percent of bad pixels of a quality mask within bounds is at most max_pct_bad.
+
+    Args:
+        quality_path: Path or GDAL virtual path to the quality mask image.
+        bounds: EPSG:4326 bounds to check.
+        get_bad_pixels: Function mapping a quality mask array to a boolean array of bad pixels.
+        max_pct_bad: Maximum percent of bad pixels allowed.
+
+    Returns:
+        True if the rounded percent of bad pixels is less than or equal to max_pct_bad.
+        Always True without reading the mask when max_pct_bad is 100 or more.
+    """
+    if max_pct_bad >= 100:
+        return True
+    bad_pixels = get_bad_pixels(read_clipped(quality_path, bounds))
+    pct_bad = int(np.round(100 * bad_pixels.mean()))
+    return pct_bad <= max_pct_bad
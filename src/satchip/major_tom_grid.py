@@ -1,5 +1,6 @@
 import math
 import re
+from functools import lru_cache
 from typing import Any
 
 import geopandas as gpd
@@ -24,6 +25,7 @@ class MajorTomGrid:
         self.utm_definition = utm_definition
         self.rows, self.lats = self.get_rows()
         self.points, self.points_by_row = self.get_points()
+        self.row_lons, self.row_cols = self.get_row_lookups()
 
     def get_rows(self) -> tuple:
         # Define set of latitudes to use, based on the grid distance
@@ -69,69 +71,64 @@ class MajorTomGrid:
         longitudes = np.sort(longitudes)
 
         if return_cols:
-            cols: list[Any] = [None] * len(longitudes)
+            # From 0R-NR and 1L-NL, sliced from label tables shared by every row
             zeroth_idx = np.where(longitudes == 0)[0][0]
-            cols[zeroth_idx:] = [f'{i}R' for i in range(len(longitudes) - zeroth_idx)]
-            cols[:zeroth_idx] = [f'{abs(i - zeroth_idx)}L' for i in range(zeroth_idx)]
-            return np.array(cols), np.array(longitudes)
+            max_divisions = math.ceil(self.get_circumference_at_latitude(0) / self.dist)
+            right_cols = get_index_labels('R', max_divisions)[: len(longitudes) - zeroth_idx]
+            left_cols = get_index_labels('L', max_divisions)[zeroth_idx:0:-1]
+            return np.concatenate([left_cols, right_cols]), np.array(longitudes)
 
         return np.array(longitudes)
 
     def get_points(self) -> tuple:
-        r_idx = 0
-        points_by_row = [None] * len(self.rows)
+        # Columns are gathered row by row as arrays and turned into a single GeoDataFrame at the end
+        row_names, row_cols, row_lats, row_lons, row_utm_zones = [], [], [], [], []
         for r, lat in zip(self.rows, self.lats):
-            (
-                point_names,
-                grid_row_names,
-                grid_col_names,
-                grid_row_idx,
-                grid_col_idx,
-                grid_lats,
-                grid_lons,
-                utm_zones,
-                epsgs,
-            ) = [], [], [], [], [], [], [], [], []
             cols, lons = self.subdivide_circumference(lat, return_cols=True)
-
             cols, lons = self.filter_longitude(cols, lons)
-            c_idx = 0
-            for c, lon in zip(cols, lons):
-                point_names.append(f'{r}_{c}')
-                grid_row_names.append(r)
-                grid_col_names.append(c)
-                grid_row_idx.append(r_idx)
-                grid_col_idx.append(c_idx)
-                grid_lats.append(lat)
-                grid_lons.append(lon)
-                if self.utm_definition == 'bottomleft':
-                    utm_zones.append(get_utm_zone_from_latlng([lat, lon]))
-                elif self.utm_definition == 'center':
-                    center_lat = lat + (1000 * self.dist / 2) / 111_120
-                    center_lon = lon + (1000 * self.dist / 2) / (111_120 * math.cos(center_lat * math.pi / 180))
-                    utm_zones.append(get_utm_zone_from_latlng([center_lat, center_lon]))
-                else:
-                    raise ValueError(f'Invalid utm_definition {self.utm_definition}')
-                epsgs.append(f'EPSG:{utm_zones[-1]}')
-
-                c_idx += 1
-            points_by_row[r_idx] = gpd.GeoDataFrame(
-                {
-                    'name': point_names,
-                    'row': grid_row_names,
-                    'col': grid_col_names,
-                    'row_idx': grid_row_idx,
-                    'col_idx': grid_col_idx,
-                    'utm_zone': utm_zones,
-                    'epsg': epsgs,
-                },
-                geometry=gpd.points_from_xy(grid_lons, grid_lats),
-            )
-            r_idx += 1
-        points = gpd.GeoDataFrame(pd.concat(points_by_row))
-        # points.reset_index(inplace=True,drop=True)
+            if self.utm_definition == 'bottomleft':
+                utm_lat, utm_lons = lat, lons
+            elif self.utm_definition == 'center':
+                utm_lat = lat + (1000 * self.dist / 2) / 111_120
+                utm_lons = lons + (1000 * self.dist / 2) / (111_120 * math.cos(utm_lat * math.pi / 180))
+            else:
+                raise ValueError(f'Invalid utm_definition {self.utm_definition}')
+            row_names.append(np.full(len(cols), r))
+            row_cols.append(cols)
+            row_lats.append(np.full(len(lons), lat))
+            row_lons.append(lons)
+            row_utm_zones.append(get_utm_zones_vec(np.full(len(utm_lons), utm_lat), utm_lons))
+
+        row_lengths = [len(cols) for cols in row_cols]
+        utm_zones = np.concatenate(row_utm_zones)
+        rows = np.concatenate(row_names)
+        cols = np.concatenate(row_cols)
+        col_idx = np.concatenate([np.arange(row_length) for row_length in row_lengths])
+        points = gpd.GeoDataFrame(
+            {
+                'name': np.char.add(np.char.add(rows, '_'), cols),
+                'row': rows,
+                'col': cols,
+                'row_idx': np.repeat(np.arange(len(self.rows)), row_lengths),
+                'col_idx': col_idx,
+                'utm_zone': utm_zones,
+                'epsg': np.char.add('EPSG:', utm_zones.astype(str)),
+            },
+            geometry=gpd.points_from_xy(np.concatenate(row_lons), np.concatenate(row_lats)),
+            # Each point is indexed by its position within its row
+            index=col_idx,
+        )
+        row_ends = np.cumsum(row_lengths)
+        points_by_row = [points.iloc[end - length : end] for end, length in zip(row_ends, row_lengths)]
         return points, points_by_row
 
+    def get_row_lookups(self) -> tuple:
+        # Plain numpy arrays of each row's longitudes and column names, so lookups skip the pandas accessors
+        row_ends = np.cumsum([len(row_points) for row_points in self.points_by_row])[:-1]
+        row_lons = np.split(self.points.geometry.x.to_numpy(), row_ends)
+        row_cols = np.split(self.points['col'].to_numpy(), row_ends)
+        return row_lons, row_cols
+
     def group_points_by_row(self) -> gpd.GeoDataFrame:
         # Make list of different gdfs for each row
         points_by_row = [None] * len(self.rows)
@@ -148,24 +145,22 @@ class MajorTomGrid:
         # Always take bottom left corner of grid cell
         rows = np.searchsorted(self.lats, lats) - 1
 
-        # Get the possible points of the grid cells at the given latitude
-        possible_points = [self.points_by_row[row] for row in rows]
-
-        # For each point, find the rightmost point that is still to the left of the given longitude
-        cols = [
-            poss_points.iloc[np.searchsorted(poss_points.geometry.x, lon) - 1].col
-            for poss_points, lon in zip(possible_points, lons)
-        ]
+        # For each point, find the rightmost point in its row that is still to the left of the given longitude.
+        # Points are grouped by row so each row's longitudes are searched once for all of its points.
+        lons_arr = np.asarray(lons)
+        cols = np.empty(len(rows), dtype=object)
+        for row in np.unique(rows):
+            in_row = rows == row
+            col_idxs = np.searchsorted(self.row_lons[row], lons_arr[in_row]) - 1
+            cols[in_row] = self.row_cols[row][col_idxs]
         rows = self.rows[rows].tolist()
 
         outputs = [list(rows), list(cols)]
         if return_idx:
             # Get the table index for self.points with each row,col pair in rows, cols
-            idx = [
-                self.points[(self.points.row == row) & (self.points.col == col)].index.values[0]
-                for row, col in zip(rows, cols)
-            ]
-            outputs.append(idx)
+            row_col_index = pd.MultiIndex.from_arrays([self.points.row, self.points.col])
+            idx = self.points.index.values[row_col_index.get_indexer(list(zip(rows, cols)))]
+            outputs.append(list(idx))
 
         # return raw numbers
         if integer:
@@ -199,17 +194,15 @@ class MajorTomGrid:
         else:
             top = self.lats[next_row_idx]
 
-        max_col = len(self.points_by_row[row_idx].col_idx) - 1
+        row_lons = self.row_lons[row_idx]
+        max_col = len(row_lons) - 1
         if (
             next_col_idx > max_col
         ):  # If at rightmost column, use difference between rightmost and second-to-rightmost column for width
-            width = (
-                self.points_by_row[row_idx].iloc[col_idx].geometry.x
-                - self.points_by_row[row_idx].iloc[col_idx - 1].geometry.x
-            )
-            right = self.points_by_row[row_idx].iloc[col_idx].geometry.x + width
+            width = row_lons[col_idx] - row_lons[col_idx - 1]
+            right = row_lons[col_idx] + width
         else:
-            right = self.points_by_row[row_idx].iloc[next_col_idx].geometry.x
+            right = row_lons[next_col_idx]
 
         # Buffer the polygon by the ratio of the grid cell's width/height
         width = right - left
@@ -229,11 +222,27 @@ class MajorTomGrid:
         return bbox
 
 
+@lru_cache(maxsize=8)
+def get_index_labels(suffix: str, n: int) -> np.ndarray:
+    """Return the grid index labels 0<suffix> through <n - 1><suffix>."""
+    return np.array([f'{i}{suffix}' for i in range(n)])
+
+
+EPSG_CODE_PATTERN = re.compile(r'32[6-7](0[1-9]|[1-5][0-9]|60)')
+
+
 def get_utm_zone_from_latlng(latlng: list) -> int:
     assert isinstance(latlng, list | tuple), 'latlng must be in the form of a list or tuple.'
 
-    longitude = latlng[1]
-    latitude = latlng[0]
+    # Every zone boundary, including the Svalbard and Norway exceptions, falls on a whole degree,
+    # so all points in the same one degree cell share a UTM zone
+    return _get_utm_zone_for_cell(math.floor(latlng[0]), math.floor(latlng[1]))
+
+
+@lru_cache(maxsize=4096)
+def _get_utm_zone_for_cell(lat_floor: int, lon_floor: int) -> int:
+    latitude = lat_floor + 0.5
+    longitude = lon_floor + 0.5
 
     zone_number = (math.floor((longitude + 180) / 6)) % 60 + 1
 
@@ -255,8 +264,26 @@ def get_utm_zone_from_latlng(latlng: list) -> int:
         epsg_code = f'327{zone_number:02d}'
     else:
         epsg_code = f'326{zone_number:02d}'
-    if not re.match(r'32[6-7](0[1-9]|[1-5][0-9]|60)', epsg_code):
-        print(f'latlng: {latlng}, epsg_code: {epsg_code}')
+    if not EPSG_CODE_PATTERN.match(epsg_code):
+        print(f'latlng cell: {[lat_floor, lon_floor]}, epsg_code: {epsg_code}')
         raise ValueError('out of bound latlng resulted in incorrect EPSG code for the point')
 
     return int(epsg_code)
+
+
+def get_utm_zones_vec(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Vectorized get_utm_zone_from_latlng, returning the UTM EPSG code of each lat/lon pair."""
+    if not (np.all(np.isfinite(lats)) and np.all(np.isfinite(lons))):
+        raise ValueError('out of bound latlng resulted in incorrect EPSG code for the point')
+
+    zone_numbers = np.floor((lons + 180) / 6).astype(int) % 60 + 1
+
+    # Special zones for Svalbard and Norway
+    norway = (lats >= 56.0) & (lats < 64.0) & (lons >= 3.0) & (lons < 12.0)
+    zone_numbers = np.where(norway, 32, zone_numbers)
+    svalbard = (lats >= 72.0) & (lats < 84.0)
+    for lon_min, lon_max, zone_number in [(0.0, 9.0, 31), (9.0, 21.0, 33), (21.0, 33.0, 35), (33.0, 42.0, 37)]:
+        zone_numbers = np.where(svalbard & (lons >= lon_min) & (lons < lon_max), zone_number, zone_numbers)
+
+    # Determine the hemisphere and construct the EPSG code
+    return np.where(lats < 0, 32700, 32600) + zone_numbers
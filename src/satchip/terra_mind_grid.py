@@ -1,11 +1,10 @@
 from itertools import product
 
 import numpy as np
-import pyproj
 from rasterio import Affine
 
 from satchip.major_tom_grid import MajorTomGrid
-from satchip.utils import get_epsg4326_bbox, get_epsg4326_point
+from satchip.utils import get_epsg4326_bbox, get_epsg4326_point, get_transformer
 
 
 TERRA_MIND_CHIP_SIZE = 264
@@ -92,15 +91,21 @@ class TerraMindGrid:
         if self.major_tom_grid.dist != 10:
             raise ValueError('This function is only valid for a grid distance of 10 km.')
 
+        # Project the grid points to their UTM zones with one vectorized transform per zone
+        points = self.major_tom_grid.points
+        utm_epsgs = points['utm_zone'].to_numpy().astype(int)
+        lons, lats = points.geometry.x.to_numpy(), points.geometry.y.to_numpy()
+        minxs, minys = np.empty(len(points)), np.empty(len(points))
+        for utm_epsg in np.unique(utm_epsgs):
+            in_zone = utm_epsgs == utm_epsg
+            minxs[in_zone], minys[in_zone] = get_transformer(4326, int(utm_epsg)).transform(
+                lons[in_zone], lats[in_zone]
+            )
+
         major_tom_chips = []
-        for _, point in self.major_tom_grid.points.iterrows():
-            utm_epsg = int(point['utm_zone'])
-            latlng = pyproj.CRS('EPSG:4326')
-            utm = pyproj.CRS(f'EPSG:{utm_epsg}')
-            latlng2utm = pyproj.Transformer.from_crs(latlng, utm, always_xy=True)
-            minx, miny = latlng2utm.transform(point.geometry.x, point.geometry.y)
+        for name, utm_epsg, minx, miny in zip(points['name'], utm_epsgs, minxs, minys):
             maxy = miny + MAJOR_TOM_CHIP_SIZE * MAJOR_TOM_PIXEL_SIZE  # 1068 pixel chip at 10m cell size
-            major_tom_chips.append(MajorTomChip(name=point['name'], minx=minx, maxy=maxy, epsg=utm_epsg))
+            major_tom_chips.append(MajorTomChip(name=name, minx=float(minx), maxy=float(maxy), epsg=int(utm_epsg)))
         return major_tom_chips
 
     @staticmethod
@@ -1,37 +1,99 @@
+import sys
+import tempfile
+import threading
+import zipfile
+from collections.abc import Iterable
+from functools import lru_cache
 from pathlib import Path
+from typing import Any
 
 import xarray as xr
 import zarr
 from pyproj import CRS, Transformer
+from tqdm import tqdm
+from zarr.codecs import BloscCodec
+
+
+@lru_cache(maxsize=128)
+def get_transformer(in_epsg: int, out_epsg: int) -> Transformer:
+    """Return an always_xy Transformer between two EPSG codes, cached since building the PROJ pipeline is slow."""
+    return Transformer.from_crs(CRS.from_epsg(in_epsg), CRS.from_epsg(out_epsg), always_xy=True)
 
 
 def get_epsg4326_point(x: float, y: float, in_epsg: int) -> tuple[float, float]:
     if in_epsg == 4326:
         return x, y
-    in_crs = CRS.from_epsg(in_epsg)
-    out_crs = CRS.from_epsg(4326)
-    transformer = Transformer.from_crs(in_crs, out_crs, always_xy=True)
-    newx, newy = transformer.transform(x, y)
+    newx, newy = get_transformer(in_epsg, 4326).transform(x, y)
     return round(newx, 5), round(newy, 5)
 
 
 def get_epsg4326_bbox(
     bounds: tuple[float, float, float, float], in_epsg: int, buffer: float = 0.1
 ) -> tuple[float, float, float, float]:
-    minx, miny = get_epsg4326_point(bounds[0], bounds[1], in_epsg)
-    maxx, maxy = get_epsg4326_point(bounds[2], bounds[3], in_epsg)
+    if in_epsg == 4326:
+        minx, miny, maxx, maxy = bounds
+    else:
+        xs, ys = get_transformer(in_epsg, 4326).transform([bounds[0], bounds[2]], [bounds[1], bounds[3]])
+        minx, maxx = round(xs[0], 5), round(xs[1], 5)
+        miny, maxy = round(ys[0], 5), round(ys[1], 5)
     bbox = minx - buffer, miny - buffer, maxx + buffer, maxy + buffer
     return bbox
 
 
-def save_chip(dataset: xr.Dataset, save_path: str | Path) -> None:
-    """Save a zipped zarr archive"""
-    store = zarr.storage.ZipStore(save_path, mode='w')
-    dataset.to_zarr(store)
+_PATH_LOCKS: dict[str, threading.Lock] = {}
+_PATH_LOCKS_GUARD = threading.Lock()
+
+
+def get_path_lock(path: str | Path) -> threading.Lock:
+    """Get a lock shared by every thread working on the given path.
+
+    Used to stop concurrent chips from downloading the same file into the scratch directory at once.
+    """
+    with _PATH_LOCKS_GUARD:
+        return _PATH_LOCKS.setdefault(str(path), threading.Lock())
+
+
+def progress_bar(iterable: Iterable[Any], total: int) -> tqdm:
+    """Wrap an iterable in a tqdm progress bar that refreshes at most twice a second and is hidden outside a TTY."""
+    return tqdm(iterable, total=total, mininterval=0.5, miniters=10, smoothing=0.05, disable=not sys.stderr.isatty())
+
+
+def get_chip_encoding(dataarray: xr.DataArray) -> dict:
+    """Get a zarr encoding that stores each sample as one chunk holding all of its times and bands.
+
+    Reading a chip then decompresses only that chip, and samples that are entirely fill value are skipped on write.
+    """
+    return {
+        'chunks': tuple(1 if dim == 'sample' else size for dim, size in dataarray.sizes.items()),
+        'compressors': (BloscCodec(cname='zstd', clevel=3, shuffle='bitshuffle'),),
+    }
+
+
+def save_chip(dataset: xr.Dataset, save_path: str | Path, encoding: dict | None = None) -> None:
+    """Save a zipped zarr archive
+
+    xarray rewrites some metadata documents while writing, which a ZipStore can only append as duplicate
+    entries. Writing to a temporary local store next to save_path first means each key is written to the zip
+    exactly once, while chunks still stream to disk instead of being held in memory.
+    Chunks holding only the fill value (e.g. samples without data) are skipped and read back as the fill value.
+    """
+    save_path = Path(save_path)
+    with tempfile.TemporaryDirectory(dir=save_path.parent, prefix=f'.{save_path.name}.') as tmp_dir:
+        # Writing straight to a ZipStore(mode='w') would be a single pass, but the root zarr.json is written
+        # again when the metadata is consolidated, and a zip can't replace an entry, so the archive would hold
+        # two root documents. The extra local copy is the price of a zip with one entry per key.
+        dataset.to_zarr(
+            zarr.storage.LocalStore(tmp_dir), encoding=encoding, consolidated=True, write_empty_chunks=False
+        )
+        # Chunks are already compressed, so entries are stored uncompressed like ZipStore does by default
+        with zipfile.ZipFile(save_path, mode='w', compression=zipfile.ZIP_STORED) as archive:
+            for path in sorted(Path(tmp_dir).rglob('*')):
+                if path.is_file():
+                    archive.write(path, path.relative_to(tmp_dir).as_posix())
 
 
 def load_chip(label_path: str | Path) -> xr.Dataset:
     """Load a zipped zarr archive"""
     store = zarr.storage.ZipStore(label_path, read_only=True)
-    dataset = xr.open_zarr(store)
+    dataset = xr.open_zarr(store, consolidated=True)
     return dataset
@@ -0,0 +1,10 @@
+import numpy as np
+
+from satchip.chip_hls import get_bad_pixels
+
+
+def test_get_bad_pixels():
+    fmask = np.arange(256, dtype=np.uint8)
+    bit_masks = np.unpackbits(fmask[..., np.newaxis], axis=-1)
+    expected = (bit_masks[..., 4] == 1) | (bit_masks[..., 6] == 1) | (bit_masks[..., 7] == 1)
+    assert np.array_equal(get_bad_pixels(fmask), expected)
@@ -0,0 +1,85 @@
+import numpy as np
+import rasterio as rio
+from rasterio import Affine
+from rasterio.crs import CRS
+from rasterio.vrt import WarpedVRT
+
+from satchip import utils
+from satchip.chip_label import _reproject_major_tom_chip, get_label_dtype, is_valuable
+from satchip.chip_xr_base import get_chip_crs
+from satchip.terra_mind_grid import TerraMindGrid
+
+
+def test_is_valuable():
+    chip = np.zeros((264, 264), dtype=np.int16)
+    assert not is_valuable(chip)
+    chip[100, 200] = 3
+    assert is_valuable(chip)
+    chip[100, 200] = -1
+    assert is_valuable(chip)
+
+
+def test_get_label_dtype():
+    label_np = np.zeros((1, 1, 2, 264, 264), dtype=np.int16)
+    label_np[0, 0, 0, 10, 10] = 255
+    assert get_label_dtype(label_np) == np.uint8
+    label_np[0, 0, 1, 10, 10] = 256
+    assert get_label_dtype(label_np) == np.int16
+    label_np[0, 0, 1, 10, 10] = -1
+    assert get_label_dtype(label_np) == np.int16
+
+
+def write_label(path, crs, transform, data):
+    profile = {'driver': 'GTiff', 'width': data.shape[1], 'height': data.shape[0], 'count': 1, 'dtype': data.dtype}
+    with rio.open(path, 'w', crs=crs, transform=transform, **profile) as dst:
+        dst.write(data, 1)
+
+
+def check_against_per_chip_warps(mt_chip, label_path):
+    results = _reproject_major_tom_chip(mt_chip, label_path)
+    tm_chips = {tm_chip.name: tm_chip for tm_chip in TerraMindGrid.get_terra_mind_chips_for_major_tom_chip(mt_chip)}
+    assert 0 < len(results) < len(tm_chips)
+    with rio.open(label_path) as src:
+        for name, chip_array in results:
+            tm_chip = tm_chips[name]
+            with WarpedVRT(
+                src,
+                crs=get_chip_crs(tm_chip.epsg),
+                transform=tm_chip.rio_transform,
+                width=tm_chip.ncol,
+                height=tm_chip.nrow,
+                nodata=np.nan,
+                dtype='float32',
+                resampling=rio.enums.Resampling.bilinear,
+                tolerance=1e-9,
+            ) as vrt:
+                expected = vrt.read(1)
+            expected = np.rint(np.nan_to_num(expected, nan=0.0)).astype(np.int16)
+            assert chip_array.shape == (tm_chip.nrow, tm_chip.ncol)
+            assert np.array_equal(chip_array, expected)
+
+
+def test_reproject_major_tom_chip(tmp_path):
+    mt_chip = TerraMindGrid(latitude_range=(34.2, 34.3), longitude_range=(-88.0, -87.9)).major_tom_chips[0]
+    # Only covers the upper left of the MajorTom chip, so some TerraMind chips are off the edge of the label
+    rng = np.random.default_rng(0)
+    data = np.kron(rng.integers(0, 10, size=(20, 20)), np.ones((16, 16))).astype(np.uint8)
+    label_path = tmp_path / 'label.tif'
+    transform = Affine(20.0, 0.0, mt_chip.minx - 1005.0, 0.0, -20.0, mt_chip.maxy + 995.0)
+    write_label(label_path, get_chip_crs(mt_chip.epsg), transform, data)
+    check_against_per_chip_warps(mt_chip, label_path)
+
+    write_label(label_path, get_chip_crs(mt_chip.epsg), transform, np.zeros_like(data))
+    assert _reproject_major_tom_chip(mt_chip, label_path) == []
+
+
+def test_reproject_major_tom_chip_geographic_label(tmp_path):
+    mt_chip = TerraMindGrid(latitude_range=(34.2, 34.3), longitude_range=(-88.0, -87.9)).major_tom_chips[0]
+    # Warping from EPSG:4326 is not affine, so this checks the mosaic warp matches warping each chip on its own
+    rng = np.random.default_rng(0)
+    data = np.kron(rng.integers(0, 10, size=(20, 20)), np.ones((16, 16))).astype(np.uint8)
+    label_path = tmp_path / 'label.tif'
+    lon, lat = utils.get_epsg4326_point(mt_chip.minx - 1000.0, mt_chip.maxy + 1000.0, mt_chip.epsg)
+    transform = Affine(0.0002, 0.0, lon, 0.0, -0.0002, lat)
+    write_label(label_path, CRS.from_epsg(4326), transform, data)
+    check_against_per_chip_warps(mt_chip, label_path)
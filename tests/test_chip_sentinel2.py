@@ -0,0 +1,43 @@
+from datetime import datetime
+
+import numpy as np
+import shapely
+from pystac.item import Item
+
+from satchip.chip_sentinel2 import get_bad_pixels, get_bbox_2d, get_items_tree
+
+
+def test_get_bad_pixels():
+    scl = np.arange(256, dtype=np.uint8)
+    expected = np.isin(scl, [0, 1, 3, 8, 9, 10])
+    assert np.array_equal(get_bad_pixels(scl), expected)
+
+
+BOUNDS = (10.0, 40.0, 11.0, 41.0)
+BBOXES = [
+    ([10.5, 40.5, 12.0, 42.0], True),  # overlapping
+    ([12.0, 40.0, 13.0, 41.0], False),  # disjoint in x
+    ([10.0, 42.0, 11.0, 43.0], False),  # disjoint in y
+    ([11.0, 41.0, 12.0, 42.0], True),  # touching at a corner
+    ([9.0, 39.0, 12.0, 42.0], True),  # containing
+    ([179.0, 40.0, -179.0, 41.0], True),  # crossing the antimeridian
+    ([11.5, 40.0, 0.0, 12.5, 41.0, 100.0], False),  # 3D, disjoint in x
+    ([10.5, 40.5, 0.0, 12.0, 42.0, 100.0], True),  # 3D, overlapping
+    (None, True),
+]
+
+
+def test_get_items_tree():
+    items = [
+        Item(id=str(i), geometry=None, bbox=bbox, datetime=datetime(2024, 1, 1), properties={})
+        for i, (bbox, _) in enumerate(BBOXES)
+    ]
+    indices = np.sort(get_items_tree(items).query(shapely.box(*BOUNDS)))
+    assert [items[i].id for i in indices] == [item.id for item, (_, expected) in zip(items, BBOXES) if expected]
+
+
+def test_get_bbox_2d():
+    assert get_bbox_2d([1.0, 2.0, 3.0, 4.0]) == (1.0, 2.0, 3.0, 4.0)
+    assert get_bbox_2d([1.0, 2.0, -10.0, 3.0, 4.0, 10.0]) == (1.0, 2.0, 3.0, 4.0)
+    assert get_bbox_2d([179.0, 2.0, -179.0, 4.0]) == (-180, -90, 180, 90)
+    assert get_bbox_2d(None) == (-180, -90, 180, 90)
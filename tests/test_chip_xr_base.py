@@ -0,0 +1,26 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from satchip.chip_xr_base import is_within_bad_pixel_limit, stack_to_chip_dataarray
+from satchip.terra_mind_grid import TerraMindChip
+
+
+def test_stack_to_chip_dataarray():
+    chip = TerraMindChip(name='test', minx=500_000.0, maxy=4_000_000.0, epsg=32616)
+    times = [datetime(2024, 1, 1), datetime(2024, 1, 6)]
+    stack = np.arange(2 * 3, dtype=np.uint16)[:, None, None] * np.ones((1, chip.nrow, chip.ncol), dtype=np.uint16)
+
+    dataarray = stack_to_chip_dataarray(stack, times, ['BLUE', 'GREEN', 'RED'], chip)
+    assert dataarray.dims == ('time', 'band', 'y', 'x')
+    assert dataarray.sel(time=times[1], band='BLUE').values[0, 0] == 3
+    assert dataarray.sel(time=times[0], band='RED').values[0, 0] == 2
+
+    with pytest.raises(ValueError, match='share an acquisition time'):
+        stack_to_chip_dataarray(stack, [times[0], times[0]], ['BLUE', 'GREEN', 'RED'], chip)
+
+
+def test_is_within_bad_pixel_limit_skips_read_at_100(tmp_path):
+    # The mask does not exist, so any attempt to read it would raise
+    assert is_within_bad_pixel_limit(tmp_path / 'missing.tif', (0, 0, 1, 1), lambda mask: mask > 0, 100)
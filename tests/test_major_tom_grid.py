@@ -0,0 +1,33 @@
+import numpy as np
+
+from satchip.major_tom_grid import MajorTomGrid, get_utm_zone_from_latlng, get_utm_zones_vec
+
+
+def test_get_utm_zones_vec():
+    lats = np.array([34.2, -33.9, 0.0, -0.5, 60.0, 60.0, 78.0, 78.0, 78.0, 78.0, 84.0, 10.0])
+    lons = np.array([-87.9, 151.2, 0.0, 179.9, 5.0, 2.9, 5.0, 15.0, 25.0, 40.0, 5.0, 180.0])
+    zones = get_utm_zones_vec(lats, lons)
+    assert zones.tolist() == [get_utm_zone_from_latlng([lat, lon]) for lat, lon in zip(lats, lons)]
+    assert zones.tolist() == [32616, 32756, 32631, 32760, 32632, 32631, 32631, 32633, 32635, 32637, 32631, 32601]
+
+
+def test_latlon2rowcol():
+    grid = MajorTomGrid(dist=10, latitude_range=(34.0, 35.0), longitude_range=(-88.0, -87.0))
+    row_lons = grid.row_lons[1]
+    lats = [
+        34.51,  # inside the grid
+        grid.lats[1],  # on a row edge, which belongs to the row below
+        grid.lats[2] - 1e-9,  # just below a row edge
+        grid.lats[1] + 0.01,  # on a column edge, which belongs to the column to the left
+        grid.lats[1] + 0.01,  # in the last column of a row
+        grid.lats[-1] + 0.01,  # in the top row
+        grid.lats[1] + 0.01,  # west of the grid, which wraps to the last column
+    ]
+    lons = [-87.49, -87.49, -87.49, row_lons[2], row_lons[-1] + 0.01, -87.49, -88.5]
+    rows, cols, idx = grid.latlon2rowcol(lats, lons, return_idx=True)
+    assert rows == ['384U', '379U', '380U', '380U', '380U', '389U', '380U']
+    assert cols == ['803L', '808L', '807L', '810L', '802L', '799L', '802L']
+    assert idx == [4, 3, 4, 1, 9, 4, 9]
+
+    rows, cols = grid.latlon2rowcol(lats[:1], lons[:1], integer=True)
+    assert (rows, cols) == ([384], [-803])
@@ -0,0 +1,88 @@
+import zipfile
+
+import numpy as np
+import pytest
+import xarray as xr
+import zarr
+from pyproj import CRS, Transformer
+
+from satchip import utils
+
+
+def get_epsg4326_bbox_per_corner(bounds, in_epsg, buffer=0.1):
+    # The per-corner transform get_epsg4326_bbox used before both corners were transformed in one call
+    transformer = Transformer.from_crs(CRS.from_epsg(in_epsg), CRS.from_epsg(4326), always_xy=True)
+    minx, miny = (round(v, 5) for v in transformer.transform(bounds[0], bounds[1]))
+    maxx, maxy = (round(v, 5) for v in transformer.transform(bounds[2], bounds[3]))
+    return minx - buffer, miny - buffer, maxx + buffer, maxy + buffer
+
+
+@pytest.mark.parametrize(
+    'bounds, in_epsg',
+    [
+        ((500_000.0, 3_780_000.0, 502_640.0, 3_782_640.0), 32616),
+        # Extends east of the -84 degree edge of UTM zone 16
+        ((775_000.0, 3_780_000.0, 790_000.0, 3_795_000.0), 32616),
+        ((300_000.0, 6_240_000.0, 302_640.0, 6_242_640.0), 32756),
+    ],
+)
+def test_get_epsg4326_bbox(bounds, in_epsg):
+    assert utils.get_epsg4326_bbox(bounds, in_epsg) == get_epsg4326_bbox_per_corner(bounds, in_epsg)
+    assert utils.get_epsg4326_bbox(bounds, in_epsg, buffer=0) == get_epsg4326_bbox_per_corner(bounds, in_epsg, 0)
+    assert utils.get_epsg4326_bbox((-88.0, 34.0, -87.0, 35.0), 4326, buffer=0) == (-88.0, 34.0, -87.0, 35.0)
+
+
+def test_get_chip_encoding():
+    dims = ('time', 'band', 'sample', 'y', 'x')
+    dataarray = xr.DataArray(np.zeros((3, 12, 100, 8, 8), dtype=np.int16), dims=dims)
+    encoding = utils.get_chip_encoding(dataarray)
+    assert encoding['chunks'] == (3, 12, 1, 8, 8)
+
+    encoding = utils.get_chip_encoding(dataarray.transpose('sample', 'time', 'band', 'y', 'x'))
+    assert encoding['chunks'] == (1, 3, 12, 8, 8)
+
+
+def test_save_load_chip(tmp_path):
+    dataset = xr.Dataset(attrs={'bounds': [0, 1, 2, 3]})
+    dataset['bands'] = xr.DataArray(np.arange(24, dtype=np.int16).reshape(2, 3, 4), dims=('sample', 'y', 'x'))
+    save_path = tmp_path / 'chips.zarr.zip'
+    utils.save_chip(dataset, save_path, encoding={'bands': utils.get_chip_encoding(dataset['bands'])})
+
+    names = [info.filename for info in zipfile.ZipFile(save_path).infolist()]
+    assert len(names) == len(set(names))
+
+    loaded = utils.load_chip(save_path)
+    assert loaded.attrs['bounds'] == [0, 1, 2, 3]
+    assert np.array_equal(loaded['bands'].values, dataset['bands'].values)
+
+
+def test_save_chip_skips_empty_chunks(tmp_path):
+    dataset = xr.Dataset()
+    dataset['bands'] = xr.DataArray(np.zeros((3, 4, 4), dtype=np.uint16), dims=('sample', 'y', 'x'))
+    dataset['bands'][1] = 7
+    save_path = tmp_path / 'chips.zarr.zip'
+    utils.save_chip(dataset, save_path, encoding={'bands': {'chunks': (1, 4, 4)}})
+
+    chunk_names = [name for name in zipfile.ZipFile(save_path).namelist() if name.startswith('bands/c/')]
+    assert chunk_names == ['bands/c/1/0/0']
+    loaded = utils.load_chip(save_path)
+    assert np.array_equal(loaded['bands'].values, dataset['bands'].values)
+
+
+def test_save_chip_streams_chunks_to_disk(tmp_path, monkeypatch):
+    written_keys = []
+    local_store_set = zarr.storage.LocalStore.set
+
+    async def set_and_record(self, key, value):
+        written_keys.append(key)
+        await local_store_set(self, key, value)
+
+    monkeypatch.setattr(zarr.storage.LocalStore, 'set', set_and_record)
+    dataset = xr.Dataset()
+    dataset['bands'] = xr.DataArray(np.ones((2, 4, 4), dtype=np.uint16), dims=('sample', 'y', 'x'))
+    save_path = tmp_path / 'chips.zarr.zip'
+    utils.save_chip(dataset, save_path, encoding={'bands': {'chunks': (1, 4, 4)}})
+
+    assert {'bands/c/0/0/0', 'bands/c/1/0/0'} <= set(written_keys)
+    assert list(tmp_path.iterdir()) == [save_path]
+    assert np.array_equal(utils.load_chip(save_path)['bands'].values, dataset['bands'].values)